@@ -1,5 +1,7 @@
 import sys
 import random
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from collections import defaultdict, Counter 
 import json
 import math
@@ -8,6 +10,11 @@ import datetime
 import numpy as np
 import torch
 
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 sys.setrecursionlimit(int(1e4))
 sys.path.insert(0, "./semantics/dreamcoder")
 from dreamcoder.dreamcoder import commandlineArguments, explorationCompression
@@ -23,6 +30,14 @@ from bin import hint
 
 from datasets import EMPTY_VALUE, MISSING_VALUE
 
+_INTERN = {} # process-wide intern table so identical input tuples share one object
+def intern_inputs(t):
+    r = _INTERN.get(t)
+    return r if r is not None else _INTERN.setdefault(t, t)
+
+_WRAPPER_POOL = {} # str(prog) -> ProgramWrapper, reused across frontier rescoring
+_WRAPPER_POOL_SIZE = 4096
+
 class ProgramWrapper(object):
     def __init__(self, prog):
         try:
@@ -32,13 +47,32 @@ class ProgramWrapper(object):
         self.prog = prog
         self.arity = len(prog.infer().functionArguments())
         self._name = None
-        self.cache = {} # used for fast computation
-    
+        # C-level memoization of evaluations; _compute already maps failures to MISSING_VALUE
+        self._cached = functools.lru_cache(maxsize=None)(self._compute)
+        self._prog_str = str(prog) # serializing the tree is O(depth), do it once
+        self._prog_len = len(self._prog_str)
+        # equivalence key for deduplication: constants compare by value, everything else by serialization
+        self._key = (self.arity, self.fn if isinstance(self.fn, int) else self._prog_str)
+
+    @staticmethod
+    def for_program(prog):
+        # reuse wrappers (and their evaluation caches) for programs seen before,
+        # skipping the evaluate([])/infer() cost of a fresh construction
+        key = str(prog)
+        wrapper = _WRAPPER_POOL.get(key)
+        if wrapper is None:
+            if len(_WRAPPER_POOL) >= _WRAPPER_POOL_SIZE:
+                _WRAPPER_POOL.clear()
+            wrapper = ProgramWrapper(prog)
+            _WRAPPER_POOL[key] = wrapper
+        return wrapper
+
     def __call__(self, inputs):
         if len(inputs) != self.arity or MISSING_VALUE in inputs:
             return MISSING_VALUE
-        if inputs in self.cache:
-            return self.cache[inputs]
+        return self._cached(intern_inputs(inputs))
+
+    def _compute(self, inputs):
         try:
             fn = self.fn
             for x in inputs:
@@ -50,7 +84,6 @@ class ProgramWrapper(object):
         except (TypeError, RecursionError, IndexError) as e:
             print(repr(e))
             fn = MISSING_VALUE
-        self.cache[inputs] = fn
         return fn
 
     def __eq__(self, prog): # only used for removing equivalent semantics
@@ -61,12 +94,10 @@ class ProgramWrapper(object):
         # if self.y is not None and prog.y is not None:
         #     assert len(self.y) == len(prog.y) # the program should be evaluated on same examples
         #     return np.mean(self.y[self.y!=None] == prog.y[self.y!=None]) > 0.95
-        if str(self.prog) != 'GT':
-            return str(self.prog) == str(prog.prog)
-        return False
+        return self._prog_str == getattr(prog, '_prog_str', None)
 
     def __str__(self):
-        return "%s %s"%(self.name, self.prog)
+        return "%s %s"%(self.name, self._prog_str)
 
     @property
     def name(self):
@@ -78,18 +109,25 @@ class ProgramWrapper(object):
             pass # TODO: assign name based on the function
         return self._name
 
-    def evaluate(self, examples, store_y=True): 
-        ys = []
-        for exp in examples:
-            y = self(exp)
-            ys.append(y)
+    def evaluate(self, examples, store_y=True):
+        # batched __call__: hoist the attribute lookups out of the loop so the
+        # hot (cached) path is a single lru_cache probe per example
+        cached = self._cached
+        intern = intern_inputs
+        arity = self.arity
+        ys = [None] * len(examples)
+        for i, exp in enumerate(examples):
+            if len(exp) != arity or MISSING_VALUE in exp:
+                ys[i] = MISSING_VALUE
+            else:
+                ys[i] = cached(intern(exp))
         return ys
 
 class NULLProgram(object):
     def __init__(self):
         self.arity = 0
         self.fn = lambda: EMPTY_VALUE
-        self.cache = {}
+        self.cache = None # never populated
         self.prog = 'NULL'
 
     def __call__(self, inputs):
@@ -107,19 +145,99 @@ class NULLProgram(object):
     def solve(self, *args):
         return []
 
-def compute_likelihood(program, examples=None, weighted_likelihood=False):
+if njit is not None:
+    @njit(cache=True)
+    def _mean_eq_i64(a, b):
+        n = a.shape[0]
+        res = np.empty(n, dtype=np.bool_)
+        s = 0
+        for i in range(n):
+            eq = a[i] == b[i]
+            res[i] = eq
+            s += eq
+        return s / n, res
+    # warm up the compiled kernel at import so the first likelihood call is not charged for it
+    _mean_eq_i64(np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64))
+else:
+    def _mean_eq_i64(a, b):
+        res = a == b
+        return float(np.mean(res)), res
+
+if njit is not None:
+    @njit(cache=True)
+    def _solve_scan(xs_arr, y_arr, inputs_arr, pos, outputs_arr):
+        n = xs_arr.shape[0]
+        m = xs_arr.shape[1]
+        out = np.empty(n, dtype=np.int64)
+        cnt = 0
+        for r in range(n):
+            ok = True
+            for j in range(m):
+                if j != pos and xs_arr[r, j] != inputs_arr[j]:
+                    ok = False
+                    break
+            if not ok:
+                continue
+            y = y_arr[r]
+            for t in range(outputs_arr.shape[0]):
+                if outputs_arr[t] == y:
+                    out[cnt] = xs_arr[r, pos]
+                    cnt += 1
+                    break
+        return out[:cnt]
+else:
+    def _solve_scan(xs_arr, y_arr, inputs_arr, pos, outputs_arr):
+        mask = np.isin(y_arr, outputs_arr)
+        for j in range(xs_arr.shape[1]):
+            if j != pos:
+                mask &= xs_arr[:, j] == inputs_arr[j]
+        return xs_arr[mask, pos]
+
+def encode_outputs(examples):
+    # most tasks produce tint: pack the outputs into an int64 array once so
+    # every program scored on these examples shares the encoding;
+    # MISSING_VALUE is itself an int so it encodes directly
+    if not examples or type(examples[0][1]) is not int:
+        return None
+    try:
+        return np.fromiter((e[1] for e in examples), dtype=np.int64, count=len(examples))
+    except (TypeError, ValueError, OverflowError): # mixed int/tuple outputs or ints beyond int64
+        return None
+
+def matches_reference(pred, ref):
+    # does pred agree with ref wherever it produced a value at all?
+    try:
+        pred_arr = np.fromiter(pred, dtype=np.int64, count=len(pred))
+        ref_arr = np.fromiter(ref, dtype=np.int64, count=len(ref))
+    except (TypeError, ValueError, OverflowError): # tuple-valued or out-of-int64 outputs
+        return all(p == r or p == MISSING_VALUE for p, r in zip(pred, ref))
+    return bool(np.all((pred_arr == ref_arr) | (pred_arr == MISSING_VALUE)))
+
+def compute_likelihood(program, examples=None, weighted_likelihood=False, gt_arr=None, inputs=None):
     if not examples:
         return 0., None
     else:
-        pred = program.evaluate([e[0] for e in examples], store_y=False)
-        gt = [e[1] for e in examples]
-        res = [x == y for x, y in zip(pred, gt)]
-        likehood = np.mean(res) 
+        if inputs is None:
+            inputs = [e[0] for e in examples]
+        pred = program.evaluate(inputs, store_y=False)
+        res = None
+        if gt_arr is None:
+            gt_arr = encode_outputs(examples)
+        if gt_arr is not None:
+            try:
+                pred_arr = np.fromiter(pred, dtype=np.int64, count=len(pred))
+            except (TypeError, ValueError, OverflowError): # tuple-valued or out-of-int64 predictions: fall back to the Python path
+                pass
+            else:
+                likehood, res = _mean_eq_i64(pred_arr, gt_arr)
+        if res is None:
+            res = np.array([x == e[1] for x, e in zip(pred, examples)])
+            likehood = np.mean(res)
         if weighted_likelihood:
             # adjust likelihood based on the number of examples and the arity
             coef = max(1, 10 * program.arity / len(examples))
             likehood /= coef
-        return likehood, np.array(res)
+        return likehood, res
 
 class Semantics(object):
     def __init__(self, idx, arity, program, gt_program=None, fewshot=False, learnable=True):
@@ -132,42 +250,88 @@ class Semantics(object):
         self.fewshot = fewshot
         self.learnable = learnable
         self.likelihood = 0. if self.learnable else 1.
-        self.cache = {}
+        # all allocated lazily on the first update, since many symbols never receive examples
+        self.cache = None # (x, y) -> count, in units of 1/cache_scale
+        self.totals = None # x -> total count over all y
+        self.best = None # x -> (y, count) for the most frequent y
+        self.ys = None # x -> list of distinct y seen so far
+        self.cache_scale = 1.0 # lazy decay: effective count = raw count * cache_scale
+        self._scan_arrays = None # int-encoded view of best, rebuilt lazily for solve
+        self._gt_np = None # int64 outputs of self.examples, rebuilt in update_examples
 
     def update_examples(self, examples):
-        examples = [x[:2] for x in examples if len(x[0]) == self.arity] 
-        for x, ys in self.cache.items():
-            for y in ys:
-                ys[y] *= 0.5
-        
+        examples = [(intern_inputs(x[0]), x[1]) for x in examples if len(x[0]) == self.arity]
+        if self.cache is None:
+            self.cache = Counter()
+            self.totals = Counter()
+            self.best = {}
+            self.ys = {}
+        # decay all counts by 0.5 in O(1) by shrinking the global scale;
+        # raw counts stay comparable since they all share the same scale
+        self.cache_scale *= 0.5
+        if self.cache_scale < 1e-300: # renormalize before 1/cache_scale overflows
+            scale = self.cache_scale
+            for k in self.cache:
+                self.cache[k] *= scale
+            for x in self.totals:
+                self.totals[x] *= scale
+            self.best = {x: (y, c * scale) for x, (y, c) in self.best.items()}
+            self.cache_scale = 1.0
+
+        inc = 1.0 / self.cache_scale
+        cache, totals, best, ys = self.cache, self.totals, self.best, self.ys
         for x, y in examples:
-            if x not in self.cache:
-                self.cache[x] = {}
-            if y not in self.cache[x]:
-                self.cache[x][y] = 0.
-            self.cache[x][y] += 1
+            key = (x, y)
+            # membership test, not c == inc: a stale count below the float
+            # precision of inc would be absorbed and re-append y to ys[x]
+            if key not in cache:
+                ys.setdefault(x, []).append(y)
+            c = cache[key] + inc
+            cache[key] = c
+            totals[x] += inc
+            b = best.get(x)
+            if b is None or y == b[0] or c > b[1]:
+                best[x] = (y, c)
+        if examples:
+            self._scan_arrays = None
 
-        
-        conf_examples = []
         conf_thres = 1
-        for x, ys in self.cache.items():
-            y, conf = max(ys.items(), key=lambda k: k[1])
-            if conf >= conf_thres and (conf / sum(ys.values())) > 0.5: # the most confident y occupies 80% of all possible prediction
-                conf_examples.append((x, y))
+        scale = self.cache_scale
+        conf_examples = [(x, y) for x, (y, c) in best.items()
+                         if c * scale >= conf_thres and (c / totals[x]) > 0.5] # the most confident y occupies 80% of all possible prediction
         self.examples = conf_examples
+        self._gt_np = encode_outputs(conf_examples) # shared by every program scored on these examples
 
-        self.likelihood, self.res = compute_likelihood(self.program, conf_examples, weighted_likelihood=True)
+        self.likelihood, self.res = compute_likelihood(self.program, conf_examples, weighted_likelihood=True, gt_arr=self._gt_np)
         self.check_solved()
 
-        acc = compute_likelihood(self.gt_program, examples)[0]
-        acc_conf = compute_likelihood(self.gt_program, conf_examples)[0]
-        print(f"Symbol-{self.idx:02d}: arity: {self.arity}, examples (conf): {len(examples)} ({len(conf_examples)}), accuracy (conf): {acc*100:.2f} ({acc_conf*100:.2f})")
+        if os.environ.get("NSR_VERBOSE"):
+            # evaluating the ground-truth program on every example is only needed for this diagnostic
+            acc = compute_likelihood(self.gt_program, examples)[0]
+            acc_conf = compute_likelihood(self.gt_program, conf_examples, gt_arr=self._gt_np)[0]
+            print(f"Symbol-{self.idx:02d}: arity: {self.arity}, examples (conf): {len(examples)} ({len(conf_examples)}), accuracy (conf): {acc*100:.2f} ({acc_conf*100:.2f})")
+        else:
+            print(f"Symbol-{self.idx:02d}: arity: {self.arity}, examples (conf): {len(examples)} ({len(conf_examples)})")
 
     def update_program(self, entry):
-        program = ProgramWrapper(entry.program)
-        likelihood = compute_likelihood(program, self.examples, weighted_likelihood=True)[0]
+        program = ProgramWrapper.for_program(entry.program)
+        k = 8
+        if self.likelihood > 0 and len(self.examples) > k:
+            # cheap upper bound from a small subsample: most frontier entries
+            # are worse than the current program and never need a full scoring
+            subset = random.sample(self.examples, k)
+            pred = program.evaluate([e[0] for e in subset], store_y=False)
+            matches = sum(x == y for x, (_, y) in zip(pred, subset))
+            coef = max(1, 10 * program.arity / len(self.examples))
+            max_possible = (matches + len(self.examples) - k) / len(self.examples) / coef
+            if max_possible < self.likelihood:
+                return
+        likelihood = compute_likelihood(program, self.examples, weighted_likelihood=True, gt_arr=self._gt_np)[0]
+        cur_len = getattr(self.program, '_prog_len', None)
+        if cur_len is None:
+            cur_len = len(str(self.program))
         if (likelihood > self.likelihood) or \
-            (likelihood == self.likelihood and len(str(program)) < len(str(self.program))):
+            (likelihood == self.likelihood and program._prog_len < cur_len):
             self.program = program
             self.likelihood = likelihood
             self.check_solved()
@@ -183,14 +347,13 @@ class Semantics(object):
             self.solved = False
 
     def __call__(self, inputs):
-        inputs = tuple([x for x in inputs if x != EMPTY_VALUE])
+        inputs = intern_inputs(tuple([x for x in inputs if x != EMPTY_VALUE]))
         if self.likelihood > 0.5:
             return self.program(inputs)
-        elif inputs in self.cache:
-            ys = self.cache[inputs]
-            candidates = [y[0] for y in ys.items()]
-            p = [y[1] for y in ys.items()]
-            p = np.array(p) / sum(p)
+        elif self.totals is not None and inputs in self.totals:
+            candidates = self.ys[inputs]
+            p = np.array([self.cache[(inputs, y)] for y in candidates])
+            p = p / p.sum()
             id = int(np.random.choice(len(p), p=p))
             output = candidates[id]
             return output
@@ -208,12 +371,34 @@ class Semantics(object):
         data_type = tint if data_type is int else tlist(tint)
         task_type = arrow(*([data_type]*(self.arity + 1)))
         if len(examples) > max_examples:
-            wrong_examples = [e for e, r in zip(examples, self.res) if not r]
-            right_examples = [e for e, r in zip(examples, self.res) if r]
-            right_examples = random.choices(right_examples, k=max_examples-len(wrong_examples))
-            examples = wrong_examples + right_examples
-            examples = random.sample(examples, k=max_examples)
-        return Task(str(self.idx), task_type, examples)
+            res = np.asarray(self.res, dtype=bool)
+            wrong_idx = np.flatnonzero(~res)
+            right_idx = np.flatnonzero(res)
+            n_right = max_examples - len(wrong_idx)
+            if n_right > 0:
+                keep_idx = np.concatenate([wrong_idx, np.random.choice(right_idx, size=n_right, replace=True)])
+            else:
+                keep_idx = wrong_idx
+            np.random.shuffle(keep_idx)
+            examples = [examples[i] for i in keep_idx[:max_examples]]
+        task = Task(str(self.idx), task_type, examples)
+        task._gt_np = encode_outputs(examples) # reused when rescoring frontier entries on this task
+        return task
+
+    def _get_scan_arrays(self):
+        if self._scan_arrays is None:
+            arity = self.arity
+            xs_rows, y_rows, rest = [], [], []
+            for x, (y, _) in (self.best or {}).items():
+                if len(x) == arity and type(y) is int and all(type(v) is int for v in x):
+                    xs_rows.append(x)
+                    y_rows.append(y)
+                else:
+                    rest.append((x, y))
+            xs_arr = np.array(xs_rows, dtype=np.int64).reshape(len(xs_rows), arity)
+            y_arr = np.array(y_rows, dtype=np.int64)
+            self._scan_arrays = (xs_arr, y_arr, rest)
+        return self._scan_arrays
 
     def solve(self, i, inputs, output_list):
         if len(inputs) != self.arity:
@@ -230,8 +415,16 @@ class Semantics(object):
             return True
 
         candidates = []
-        for xs, y in self.cache.items():
-            y = sorted(y.items(), key = lambda p: p[1], reverse=True)[0][0]
+        xs_arr, y_arr, rest = self._get_scan_arrays()
+        if xs_arr.shape[0] and 0 <= i < self.arity \
+                and all(type(v) is int for v in inputs) and all(type(v) is int for v in output_list):
+            hits = _solve_scan(xs_arr, y_arr, np.array(inputs, dtype=np.int64), i,
+                               np.array(output_list, dtype=np.int64))
+            candidates.extend(int(v) for v in hits)
+            pairs = rest # entries with tuple-valued inputs/outputs still need the Python scan
+        else:
+            pairs = [(x, y) for x, (y, _) in (self.best or {}).items()]
+        for xs, y in pairs:
             if y in output_list and equal(xs, inputs, i):
                 candidates.append(xs[i])
         
@@ -254,7 +447,13 @@ class Semantics(object):
         self.program = NULLProgram()
         self.solved = False
         self.likelihood = 0.
-        self.cache = {}
+        self.cache = None
+        self.totals = None
+        self.best = None
+        self.ys = None
+        self.cache_scale = 1.0
+        self._scan_arrays = None
+        self._gt_np = None
     
     def save(self):
         model = {'idx': self.idx, 'solved': self.solved, 'likelihood': self.likelihood, 'arity': self.arity}
@@ -324,6 +523,9 @@ class DreamCoder(object):
         self.allFrontiers = None
         self.helmholtzFrontiers = None
         self.learn_count = 0
+        # reference wrappers for update_grammar, built once so their caches persist across rounds
+        self._add_wrap = ProgramWrapper(hint.add)
+        self._minus0_wrap = ProgramWrapper(hint.minus0)
 
     def __call__(self):
         return self.semantics
@@ -350,24 +552,26 @@ class DreamCoder(object):
         if self.allFrontiers is None:
             return
         print('Rescoring %d frontiers...'%len(self.allFrontiers))
-        id2task = {t.name: t for t in tasks}
-        id2frontier = {f.task.name: f for f in self.allFrontiers}
         allFrontiers = {}
-        for name in id2task.keys():
-            task = id2task[name]
+        for task in tasks:
             examples = task.examples
-            if name not in id2frontier:
+            frontier = self.allFrontiers.get(task.name)
+            if frontier is None:
                 frontier = Frontier([], task=task)
             else:
-                frontier = id2frontier[name]
                 frontier.task = task
+                # encode the examples once per task; every entry reuses the same batch
+                xs_batch = [e[0] for e in examples]
+                gt_np = getattr(task, '_gt_np', None)
+                if gt_np is None:
+                    gt_np = encode_outputs(examples)
                 for entry in frontier.entries:
-                    program = ProgramWrapper(entry.program)
-                    entry.logLikelihood = float(np.log(compute_likelihood(program=program, examples=examples)[0]))
+                    program = ProgramWrapper.for_program(entry.program)
+                    entry.logLikelihood = float(np.log(compute_likelihood(program=program, examples=examples, gt_arr=gt_np, inputs=xs_batch)[0]))
                     entry.logPosterior = entry.logLikelihood + entry.logPrior
                 frontier.removeLowLikelihood(low=0.1)
 
-            allFrontiers[task] = frontier
+            allFrontiers[task.name] = frontier
         self.allFrontiers = allFrontiers
 
     def learn(self, dataset):
@@ -375,10 +579,16 @@ class DreamCoder(object):
         learning_interval = 5
         tasks = []
         max_arity = 0
-        for smt, exps in zip(self.semantics, dataset):
-            if not smt.learnable:
-                continue
-            smt.update_examples(exps)
+        pairs = [(smt, exps) for smt, exps in zip(self.semantics, dataset) if smt.learnable]
+        cpus = min(numberOfCPUs(), 8)
+        if cpus > 1 and len(pairs) > 1:
+            # the per-symbol updates are independent: each semantics owns its caches
+            with ThreadPoolExecutor(max_workers=cpus) as pool:
+                list(pool.map(lambda p: p[0].update_examples(p[1]), pairs))
+        else:
+            for smt, exps in pairs:
+                smt.update_examples(exps)
+        for smt, exps in pairs:
             if self.learn_count % learning_interval == 0:
                 t = smt.make_task()
                 if t is not None:
@@ -410,7 +620,7 @@ class DreamCoder(object):
                 self.helmholtzFrontiers = None
 
         result = explorationCompression(self.grammar, tasks, **self.train_args)
-        self.allFrontiers = list(result.allFrontiers.values())
+        self.allFrontiers = {f.task.name: f for f in result.allFrontiers.values()}
         self.helmholtzFrontiers = result.helmholtzFrontiers
 
         for frontier in result.taskSolutions.values():
@@ -427,17 +637,20 @@ class DreamCoder(object):
     def update_grammar(self):
         new_primitives = []
         for smt in self.semantics:
-            if '#' in str(smt.program) or '+' in str(smt.program) or '-' in str(smt.program):
+            prog_str = getattr(smt.program, '_prog_str', None)
+            if prog_str is None:
+                prog_str = str(smt.program)
+            if '#' in prog_str or '+' in prog_str or '-' in prog_str:
                 # if '#+-' in the program, the program uses a invented primitive, it is very likely to have a high computation cost.
                 # Therefore we don't add this program into primitives, since it might slow the enumeration a lot.
                 # it might be resolved by increasing the enumeration time
                 continue
             if smt.learnable and smt.solved and smt.arity == 2:
-                add = ProgramWrapper(hint.add)
-                minus0 = ProgramWrapper(hint.minus0)
-                if np.all([smt.program(x) in [add(x), MISSING_VALUE] for x, y in smt.examples]):
+                inputs = [x for x, y in smt.examples]
+                smt_out = smt.program.evaluate(inputs, store_y=False)
+                if matches_reference(smt_out, self._add_wrap.evaluate(inputs, store_y=False)):
                     new_primitives.append(hint.add)
-                elif np.all([smt.program(x) in [minus0(x), MISSING_VALUE] for x, y in smt.examples]):
+                elif matches_reference(smt_out, self._minus0_wrap.evaluate(inputs, store_y=False)):
                     new_primitives.append(hint.minus0)
                 else:
                     new_primitives.append(Invented(smt.program.prog))
@@ -468,17 +681,14 @@ class DreamCoder(object):
                 if smt.program is not None:
                     smt.program.evaluate(examples)
         
-        for i in range(len(self.semantics) - 1):
-            smt_i = self.semantics[i]
-            if smt_i.program is None:
+        buckets = defaultdict(list)
+        for smt in self.semantics:
+            if isinstance(smt.program, ProgramWrapper):
+                buckets[smt.program._key].append(smt)
+        for group in buckets.values():
+            if len(group) <= 1:
                 continue
-            for j in range(i+1, len(self.semantics)):
-                smt_j = self.semantics[j]
-                if smt_j.program is None:
-                    continue
-                if smt_i.program == smt_j.program:
-                    if len(smt_i.examples) >= len(smt_j.examples):
-                        smt_j.clear()
-                    else:
-                        smt_i.clear()
-                        break
+            keep = max(group, key=lambda smt: len(smt.examples))
+            for smt in group:
+                if smt is not keep:
+                    smt.clear()